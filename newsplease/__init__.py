@@ -26,10 +26,27 @@ class NewsPlease:
         """
         Extracts relevant information from a WARC record. This function does not invoke scrapy but only uses the article
         extractor.
+        :param warc_record: FastWARC response record, whose payload has not been read yet
+        :return:
+        """
+        if warc_record.http_headers is None:
+            warc_record.parse_http()
+        raw_html = warc_record.reader.read()
+        url = warc_record.headers.get('WARC-Target-URI')
+        download_date = warc_record.headers.get('WARC-Date')
+        return NewsPlease.from_warc_payload(raw_html, url=url, download_date=download_date)
+
+    @staticmethod
+    def from_warc_payload(raw_html, url=None, download_date=None):
+        """
+        Extracts relevant information from the raw HTTP payload of a WARC response record, e.g., as yielded by
+        CommonCrawlExtractor. Other than from_html, this function first detects the encoding of the payload.
+        :param raw_html:
+        :param url:
+        :param download_date:
         :return:
         """
         try:
-            raw_html = warc_record.read_stream
             ud_html = UnicodeDammit(raw_html).unicode_markup
             ftfy_html = ftfy.fix_text(ud_html)
             html = ftfy_html.encode('utf-8')  # this will also uncurl quotes
@@ -42,8 +59,6 @@ class NewsPlease:
         #        html = raw_html.decode('latin1').encode('utf-8')
         #    except UnicodeDecodeError:
         #        html = str(raw_html)
-        url = warc_record.rec_headers.get_header('WARC-Target-URI')
-        download_date = warc_record.rec_headers.get_header('WARC-Date')
         article = NewsPlease.from_html(html, url=url, download_date=download_date)
         return article
 
@@ -6,14 +6,16 @@ not otherwise specified.
 """
 import logging
 import os
-import subprocess
+import time
 from functools import partial
 from multiprocessing import Pool
 
-from dateutil import parser
+import boto3
+from botocore import UNSIGNED
+from botocore.client import Config
 from scrapy.utils.log import configure_logging
 
-from ..crawler.commoncrawl_extractor import CommonCrawlExtractor
+from ..crawler.commoncrawl_extractor import CommonCrawlExtractor, parse_date
 
 __author__ = "Felix Hamborg"
 __copyright__ = "Copyright 2017"
@@ -21,12 +23,18 @@ __credits__ = ["Sebastian Nagel"]
 
 # commoncrawl.org
 __cc_base_url = 'https://commoncrawl.s3.amazonaws.com/'
+__cc_bucket = 'commoncrawl'
+__cc_news_crawl_prefix = 'crawl-data/CC-NEWS/'
+
+# file name of the cached index of news crawl files, stored in the download dir
+__remote_index_cache_filename = '.cc_index.cache'
 
 # log file of fully extracted WARC files
 __log_pathname_fully_extracted_warcs = './fullyextractedwarcs.list'
 
 # logging
-logging.basicConfig(level=logging.INFO)
+if not logging.getLogger().handlers:
+    logging.basicConfig(level=logging.INFO)
 __logger = logging.getLogger(__name__)
 
 
@@ -48,7 +56,6 @@ def __setup(local_download_dir_warc, log_level):
     logging.getLogger('urllib3').setLevel(logging.CRITICAL)
 
     # set own logger
-    logging.basicConfig(level=log_level)
     __logger = logging.getLogger(__name__)
     __logger.setLevel(log_level)
 
@@ -60,7 +67,7 @@ def __get_publishing_date(warc_record, article):
     :return:
     """
     if article.publish_date:
-        return parser.parse(article.publish_date)
+        return parse_date(article.publish_date)
     else:
         return None
 
@@ -74,38 +81,49 @@ def __get_download_url(name):
     return __cc_base_url + name
 
 
-def __get_remote_index():
+def __get_remote_index(local_download_dir_warc, remote_index_cache_ttl):
     """
-    Gets the index of news crawl files from commoncrawl.org and returns an array of names
+    Gets the index of news crawl files from commoncrawl.org and returns an array of names. Listing the bucket is slow,
+    hence the index is cached in the download dir and only listed again once the cache is older than
+    remote_index_cache_ttl seconds
+    :param local_download_dir_warc:
+    :param remote_index_cache_ttl:
     :return:
     """
-    # cleanup
-    subprocess.getoutput("rm tmpaws.txt")
+    cache_pathname = os.path.join(local_download_dir_warc, __remote_index_cache_filename)
+    if os.path.isfile(cache_pathname) and time.time() - os.path.getmtime(cache_pathname) < remote_index_cache_ttl:
+        __logger.info('using cached index: %s', cache_pathname)
+        with open(cache_pathname) as cache_file:
+            return cache_file.read().splitlines()
+
     # get the remote info
-    cmd = "aws s3 ls --recursive s3://commoncrawl/crawl-data/CC-NEWS/ --no-sign-request > .tmpaws.txt && " \
-          "awk '{ print $4 }' .tmpaws.txt && " \
-          "rm .tmpaws.txt"
-    __logger.info('executing: %s', cmd)
-    stdout_data = subprocess.getoutput(cmd)
+    __logger.info('listing s3://%s/%s', __cc_bucket, __cc_news_crawl_prefix)
+    s3_client = boto3.client('s3', config=Config(signature_version=UNSIGNED))
+    paginator = s3_client.get_paginator('list_objects_v2')
+    names = [s3_object['Key']
+             for page in paginator.paginate(Bucket=__cc_bucket, Prefix=__cc_news_crawl_prefix)
+             for s3_object in page.get('Contents', [])]
 
-    lines = stdout_data.splitlines()
-    return lines
+    # write to a temporary file first, so that other runs never read a partially written cache
+    tmp_pathname = cache_pathname + '.tmp'
+    with open(tmp_pathname, 'w') as cache_file:
+        cache_file.write('\n'.join(names))
+    os.replace(tmp_pathname, cache_pathname)
+
+    return names
 
 
 def __get_list_of_fully_extracted_warc_urls():
     """
-    Reads in the log file that contains a list of all previously, fully extracted WARC urls
+    Reads in the log file that contains a list of all previously, fully extracted WARC urls. The file is read once per
+    run and returned as a set, so that checking each WARC url of the index is a constant time lookup
     :return:
     """
     if not os.path.isfile(__log_pathname_fully_extracted_warcs):
-        return []
+        return set()
 
     with open(__log_pathname_fully_extracted_warcs) as log_file:
-        list_warcs = log_file.readlines()
-    # remove break lines
-    list_warcs = [x.strip() for x in list_warcs]
-
-    return list_warcs
+        return set(log_file.read().splitlines())
 
 
 def __start_commoncrawl_extractor(warc_download_url, callback_on_article_extracted=None, valid_hosts=None,
@@ -116,9 +134,13 @@ def __start_commoncrawl_extractor(warc_download_url, callback_on_article_extract
                                   log_level=logging.ERROR,
                                   delete_warc_after_extraction=True,
                                   continue_process=True,
-                                  log_pathname_fully_extracted_warcs=None):
+                                  log_pathname_fully_extracted_warcs=None,
+                                  extract_while_downloading=True,
+                                  download_num_connections=8):
     """
     Starts a single CommonCrawlExtractor
+    :param extract_while_downloading:
+    :param download_num_connections:
     :param warc_download_url:
     :param callback_on_article_extracted:
     :param valid_hosts:
@@ -143,18 +165,26 @@ def __start_commoncrawl_extractor(warc_download_url, callback_on_article_extract
                                                    show_download_progress=show_download_progress,
                                                    log_level=log_level,
                                                    delete_warc_after_extraction=delete_warc_after_extraction,
-                                                   log_pathname_fully_extracted_warcs=__log_pathname_fully_extracted_warcs)
+                                                   log_pathname_fully_extracted_warcs=__log_pathname_fully_extracted_warcs,
+                                                   extract_while_downloading=extract_while_downloading,
+                                                   download_num_connections=download_num_connections)
 
 
 def crawl_from_commoncrawl(callback_on_article_extracted, valid_hosts=None, start_date=None, end_date=None,
                            strict_date=True, reuse_previously_downloaded_files=True, local_download_dir_warc=None,
                            continue_after_error=True, show_download_progress=False,
                            number_of_extraction_processes=4, log_level=logging.ERROR,
-                           delete_warc_after_extraction=True, continue_process=True, warc_file=None):
+                           delete_warc_after_extraction=True, continue_process=True, warc_file=None,
+                           remote_index_cache_ttl=3600, extract_while_downloading=True, download_num_connections=8):
     """
     Crawl and extract articles form the news crawl provided by commoncrawl.org. For each article that was extracted
     successfully the callback function callback_on_article_extracted is invoked where the first parameter is the
     article object.
+    :param extract_while_downloading: if True, records of a WARC file are extracted while it is still being downloaded.
+    Otherwise, each WARC file is downloaded completely, using concurrent range requests, before the extraction starts
+    :param download_num_connections: number of concurrent range requests if extract_while_downloading is False
+    :param remote_index_cache_ttl: seconds for which the cached index of news crawl files is used before the bucket is
+    listed again
     :param continue_process:
     :param delete_warc_after_extraction:
     :param number_of_extraction_processes:
@@ -176,7 +206,7 @@ def crawl_from_commoncrawl(callback_on_article_extracted, valid_hosts=None, star
     __logger.info('creating extraction process pool with %i processes', number_of_extraction_processes)
     warc_download_urls = []
     if warc_file is None:
-        cc_news_crawl_names = __get_remote_index()
+        cc_news_crawl_names = __get_remote_index(local_download_dir_warc, remote_index_cache_ttl)
         __logger.info('found %i files at commoncrawl.org', len(cc_news_crawl_names))
         fully_extracted_warc_urls = __get_list_of_fully_extracted_warc_urls()
         for name in cc_news_crawl_names:
@@ -210,7 +240,9 @@ def crawl_from_commoncrawl(callback_on_article_extracted, valid_hosts=None, star
                                                 show_download_progress=show_download_progress,
                                                 log_level=log_level,
                                                 delete_warc_after_extraction=delete_warc_after_extraction,
-                                                log_pathname_fully_extracted_warcs=__log_pathname_fully_extracted_warcs),
+                                                log_pathname_fully_extracted_warcs=__log_pathname_fully_extracted_warcs,
+                                                extract_while_downloading=extract_while_downloading,
+                                                download_num_connections=download_num_connections),
                                         warc_download_urls)
     else:
         for warc_download_url in warc_download_urls:
@@ -225,4 +257,6 @@ def crawl_from_commoncrawl(callback_on_article_extracted, valid_hosts=None, star
                                           show_download_progress=show_download_progress,
                                           log_level=log_level,
                                           delete_warc_after_extraction=delete_warc_after_extraction,
-                                          log_pathname_fully_extracted_warcs=__log_pathname_fully_extracted_warcs)
+                                          log_pathname_fully_extracted_warcs=__log_pathname_fully_extracted_warcs,
+                                          extract_while_downloading=extract_while_downloading,
+                                          download_num_connections=download_num_connections)
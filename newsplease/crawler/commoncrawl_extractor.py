@@ -4,18 +4,31 @@ Provides functionality to crawl and extract news articles from a single WARC fil
 and host list, can be defined. Currently, the WARC file will be downloaded to the path WORKINGDIR/cc_download_warc, if
 not otherwise specified.
 """
+import datetime
+import hashlib
+import io
 import logging
+import mmap
 import os
-import subprocess
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 from ago import human
 from dateutil import parser
 from hurry.filesize import size
 from scrapy.utils.log import configure_logging
+from fastwarc.stream_io import FileStream, GZipStream
+from fastwarc.warc import ArchiveIterator, WarcRecordType
 from six.moves import urllib
-from warcio.archiveiterator import ArchiveIterator
+
+try:
+    # optional, ISA-L inflates gzip considerably faster than zlib
+    from isal import igzip
+except ImportError:
+    igzip = None
 
 from .. import NewsPlease
 
@@ -23,15 +36,174 @@ __author__ = "Felix Hamborg"
 __copyright__ = "Copyright 2017"
 __credits__ = ["Sebastian Nagel"]
 
+# logging
+if not logging.getLogger().handlers:
+    logging.basicConfig(level=logging.INFO)
+
+
+@lru_cache(maxsize=65536)
+def parse_date(date_string):
+    """
+    Parses a date string. Many articles share the same date string, hence the results are cached. ISO 8601 dates are
+    parsed with datetime.fromisoformat, which is much faster than dateutil, any other format with dateutil.
+    :param date_string:
+    :return:
+    """
+    try:
+        return datetime.datetime.fromisoformat(date_string)
+    except ValueError:
+        return parser.parse(date_string)
+
+
+def _is_valid_host(hostname, valid_hosts):
+    """
+    Checks whether the host name is one of the valid hosts or a subdomain of one of them
+    :param hostname: lower case host name, e.g., www.elrancaguino.cl
+    :param valid_hosts: set of lower case host names, e.g., {'elrancaguino.cl'}
+    :return:
+    """
+    while hostname:
+        if hostname in valid_hosts:
+            return True
+        # strip the leftmost label, i.e., check the parent domain next
+        hostname = hostname.partition('.')[2]
+    return False
+
+
+# size of the blocks in which downloads are written to disk
+_DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+
+
+def _copy_response_to_file(response, local_file, reporthook, cancelled=None):
+    """
+    Copies an HTTP response to a file in large blocks. All blocks are read into the same buffer, so that no bytes
+    object is created per block.
+    :param response:
+    :param local_file:
+    :param reporthook: called with the number of bytes read so far, 1, and the total size (-1 if unknown)
+    :param cancelled: optional event to stop copying
+    :return: True if the response has been copied completely, False if copying was cancelled
+    :raises ContentTooShortError: if the connection was closed before the announced number of bytes has been read
+    """
+    total_size = int(response.headers.get('Content-Length', -1))
+    buffer = memoryview(bytearray(_DOWNLOAD_BLOCK_SIZE))
+    read_so_far = 0
+    while cancelled is None or not cancelled.is_set():
+        length = response.readinto(buffer)
+        if not length:
+            if 0 <= total_size != read_so_far:
+                raise urllib.error.ContentTooShortError(
+                    'retrieval incomplete: got only %i out of %i bytes' % (read_so_far, total_size), None)
+            return True
+        local_file.write(buffer[:length])
+        local_file.flush()
+        read_so_far += length
+        reporthook(read_so_far, 1, total_size)
+    return False
+
+
+def _drop_from_page_cache(path):
+    """
+    Advises the kernel that a file will not be read again, so that it does not evict more useful data, e.g., the
+    extractor processes' memory, from the page cache. Does nothing on systems without posix_fadvise.
+    :param path:
+    :return:
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+class _WarcDownloadThread(threading.Thread):
+    """
+    Downloads a file in the background, so that it can be read with _GrowingFileReader while it is still being
+    downloaded
+    """
+
+    def __init__(self, url, local_filepath, reporthook):
+        super(_WarcDownloadThread, self).__init__()
+        self.daemon = True
+        self.url = url
+        self.local_filepath = local_filepath
+        self.reporthook = reporthook
+        # set once the thread stops writing, regardless of whether the download completed
+        self.finished = threading.Event()
+        self.cancelled = threading.Event()
+        self.completed = False
+        self.error = None
+        # create the file right away, so that it can be opened for reading before the first block has arrived
+        open(local_filepath, 'wb').close()
+
+    def run(self):
+        try:
+            with urllib.request.urlopen(self.url) as response, open(self.local_filepath, 'wb') as local_file:
+                self.completed = _copy_response_to_file(response, local_file, self.reporthook, self.cancelled)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished.set()
+
+
+class _GrowingFileReader(io.RawIOBase):
+    """
+    Read-only stream that reads a file while a _WarcDownloadThread is still writing it. Reads wait until more data has
+    been written or the download has finished.
+    """
+
+    def __init__(self, download_thread):
+        super(_GrowingFileReader, self).__init__()
+        self.__download_thread = download_thread
+        self.__file = open(download_thread.local_filepath, 'rb')
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        # decompressors check this even if they only determine their position
+        return True
+
+    def readinto(self, buffer):
+        finished = self.__download_thread.finished
+        while True:
+            # check before reading, so that data written right before the download finished is not missed
+            is_finished = finished.is_set()
+            if is_finished and self.__download_thread.error is not None:
+                # do not pass a partial file to the extraction as if it was complete
+                raise self.__download_thread.error
+            length = self.__file.readinto(buffer)
+            if length or is_finished:
+                return length
+            finished.wait(0.1)
+
+    def tell(self):
+        return self.__file.tell()
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        """
+        Seeks like in a regular file. Positions that have not been downloaded yet are valid, reads then wait for them.
+        Seeking relative to the end is only supported once the download has finished, since the size is unknown before.
+        """
+        if whence == io.SEEK_END and not self.__download_thread.finished.is_set():
+            raise io.UnsupportedOperation('cannot seek relative to the end of a file that is still being downloaded')
+        return self.__file.seek(offset, whence)
+
+    def close(self):
+        self.__file.close()
+        super(_GrowingFileReader, self).close()
+
 
 class CommonCrawlExtractor:
     # remote url where we can download the warc file
     __warc_download_url = None
     # download dir for warc files
     __local_download_dir_warc = './cc_download_warc/'
-    # hosts (if None or empty list, any host is OK)
+    # hosts (if None or empty list, any host is OK), subdomains of these hosts are OK as well
     __filter_valid_hosts = []  # example: ['elrancaguino.cl']
-    # start date (if None, any date is OK as start date), as datetime
+    # start date (if None, any date is OK as start date), as datetime. Naive datetimes are treated as UTC
     __filter_start_date = None
     # end date (if None, any date is OK as end date)
     __filter_end_date = None
@@ -45,7 +217,7 @@ class CommonCrawlExtractor:
     # log level
     __log_level = logging.INFO
     __delete_warc_after_extraction = True
-    ____log_pathname_fully_extracted_warcs = None
+    __log_pathname_fully_extracted_warcs = None
 
     # commoncrawl.org
     __cc_base_url = 'https://commoncrawl.s3.amazonaws.com/'
@@ -55,9 +227,15 @@ class CommonCrawlExtractor:
     __callback_on_article_extracted = None
     # if the download progress is shown
     __show_download_progress = False
+    # number of concurrent HTTP range requests used to download a WARC file
+    __download_num_connections = 8
+    # files smaller than this (in bytes) are downloaded with a single request
+    __download_min_size_for_ranges = 64 * 1024 * 1024
+    # if True, records are extracted while the WARC file is still being downloaded. Otherwise, the WARC file is
+    # downloaded completely (using range requests) before the extraction starts
+    __extract_while_downloading = True
 
     # logging
-    logging.basicConfig(level=__log_level)
     __logger = logging.getLogger(__name__)
 
     def __setup(self):
@@ -78,7 +256,6 @@ class CommonCrawlExtractor:
         logging.getLogger('urllib3').setLevel(logging.CRITICAL)
 
         # set own logger
-        logging.basicConfig(level=self.__log_level)
         self.__logger = logging.getLogger(__name__)
         self.__logger.setLevel(self.__log_level)
 
@@ -98,7 +275,7 @@ class CommonCrawlExtractor:
         :return:
         """
         if 'publish_date' in article:
-            return parser.parse(article.publish_date)
+            return parse_date(article.publish_date)
         else:
             return None
 
@@ -110,24 +287,6 @@ class CommonCrawlExtractor:
         """
         return self.__cc_base_url + name
 
-    def __get_remote_index(self):
-        """
-        Gets the index of news crawl files from commoncrawl.org and returns an array of names
-        :return:
-        """
-        # cleanup
-        subprocess.getoutput("rm tmpaws.txt")
-        # get the remote info
-        cmd = "aws s3 ls --recursive s3://commoncrawl/crawl-data/CC-NEWS/ --no-sign-request > tmpaws.txt && " \
-              "awk '{ print $4 }' tmpaws.txt && " \
-              "rm tmpaws.txt"
-        self.__logger.info('executing: %s', cmd)
-        stdout_data = subprocess.getoutput(cmd)
-        print(stdout_data)
-
-        lines = stdout_data.splitlines()
-        return lines
-
     def __on_download_progress_update(self, blocknum, blocksize, totalsize):
         """
         Prints some download progress information
@@ -148,16 +307,108 @@ class CommonCrawlExtractor:
         else:  # total size is unknown
             sys.stdout.write("\rread %s" % (size(readsofar)))
 
+    def __get_remote_size(self, url):
+        """
+        Gets the size of a remote file
+        :param url:
+        :return: size in bytes, or None if the size is unknown or the server does not support range requests
+        """
+        request = urllib.request.Request(url, method='HEAD')
+        with urllib.request.urlopen(request) as response:
+            content_length = response.headers.get('Content-Length')
+            accept_ranges = response.headers.get('Accept-Ranges')
+
+        if content_length is None or accept_ranges != 'bytes':
+            return None
+        return int(content_length)
+
+    def __download_ranges(self, url, local_filepath, total_size):
+        """
+        Downloads a file using several concurrent HTTP range requests. The local file is memory mapped, so each range
+        is written directly at its offset and no merging is needed afterwards.
+        :param url:
+        :param local_filepath:
+        :param total_size: size of the remote file in bytes
+        :return:
+        """
+        range_size = -(-total_size // self.__download_num_connections)
+        progress_lock = threading.Lock()
+        progress = [0]
+
+        def download_range(start):
+            end = min(start + range_size, total_size)
+            request = urllib.request.Request(url, headers={'Range': 'bytes=%d-%d' % (start, end - 1)})
+            with urllib.request.urlopen(request) as response, memoryview(local_map) as local_view:
+                if response.status != 206:
+                    raise IOError('range request not supported by %s' % url)
+                offset = start
+                while offset < end:
+                    # read directly into the mapped file, without an intermediate bytes object
+                    length = response.readinto(local_view[offset:min(offset + _DOWNLOAD_BLOCK_SIZE, end)])
+                    if not length:
+                        raise IOError('connection closed at byte %d of %s' % (offset, url))
+                    offset += length
+                    with progress_lock:
+                        progress[0] += length
+                        self.__on_download_progress_update(progress[0], 1, total_size)
+
+        try:
+            with open(local_filepath, 'wb+') as local_file:
+                local_file.truncate(total_size)
+                local_map = mmap.mmap(local_file.fileno(), total_size)
+                try:
+                    with ThreadPoolExecutor(self.__download_num_connections) as executor:
+                        # consume the results, so that exceptions in any of the threads are raised here
+                        list(executor.map(download_range, range(0, total_size, range_size)))
+                finally:
+                    local_map.close()
+        except Exception:
+            # do not leave a partial file behind that would be reused by the next run
+            os.remove(local_filepath)
+            raise
+
+    def __get_local_filepath(self, url):
+        """
+        Creates the local file path of a downloaded file given its url. Files are named by the SHA-256 of their url and
+        spread over 256 sub dirs by the first two hex digits of the hash, so that no single dir grows too large. The url
+        of each file is stored next to it in a .url file, see __register_local_file.
+        :param url:
+        :return:
+        """
+        url_hash = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        local_dir = os.path.join(self.__local_download_dir_warc, url_hash[:2])
+        os.makedirs(local_dir, exist_ok=True)
+        return os.path.join(local_dir, url_hash + '.warc.gz')
+
+    def __register_local_file(self, url, local_filepath):
+        """
+        Saves the url of a downloaded file next to it, so that the file can be identified by humans
+        :param url:
+        :param local_filepath:
+        :return:
+        """
+        with open(local_filepath + '.url', 'w') as url_file:
+            url_file.write(url + '\n')
+
+    def __is_reusable_download(self, local_filepath):
+        """
+        Checks whether a previously downloaded file exists and should be used instead of downloading it again. A file
+        is only complete once its .url file exists, since that is written after the download has finished
+        :param local_filepath:
+        :return:
+        """
+        return self.__reuse_previously_downloaded_files and os.path.isfile(local_filepath) \
+            and os.path.isfile(local_filepath + '.url')
+
     def __download(self, url):
         """
         Download and save a file locally.
         :param url: Where to download from
         :return: File path name of the downloaded file
         """
-        local_filename = urllib.parse.quote_plus(url)
-        local_filepath = os.path.join(self.__local_download_dir_warc, local_filename)
+        local_filepath = self.__get_local_filepath(url)
 
-        if os.path.isfile(local_filepath) and self.__reuse_previously_downloaded_files:
+        if self.__is_reusable_download(local_filepath):
             self.__logger.info("found local file %s, not downloading again due to configuration", local_filepath)
             return local_filepath
         else:
@@ -169,7 +420,19 @@ class CommonCrawlExtractor:
 
             # download
             self.__logger.info('downloading %s (local: %s)', url, local_filepath)
-            urllib.request.urlretrieve(url, local_filepath, reporthook=self.__on_download_progress_update)
+            total_size = self.__get_remote_size(url)
+            if total_size is not None and total_size >= self.__download_min_size_for_ranges:
+                self.__download_ranges(url, local_filepath, total_size)
+            else:
+                try:
+                    with urllib.request.urlopen(url) as response, open(local_filepath, 'wb') as local_file:
+                        _copy_response_to_file(response, local_file, self.__on_download_progress_update)
+                except Exception:
+                    # do not leave a partial file behind that would be reused by the next run
+                    if os.path.isfile(local_filepath):
+                        os.remove(local_filepath)
+                    raise
+            self.__register_local_file(url, local_filepath)
             self.__logger.info('download completed, local file: %s', local_filepath)
             return local_filepath
 
@@ -186,21 +449,100 @@ class CommonCrawlExtractor:
         counter_article_discarded = 0
         start_time = time.time()
 
-        def read_record(record):
-            record.read_stream = record.raw_stream.read()
-            return record
+        self.__logger.info('Extracting records from %s', path_name)
+        # igzip can only read from Python file objects, FastWARC's own FileStream is faster otherwise
+        raw_stream = open(path_name, 'rb') if igzip is not None else FileStream(path_name, 'rb')
+        try:
+            self.__process_warc_gz_stream(raw_stream)
+        finally:
+            raw_stream.close()
 
-        def delete_raw_stream(record):
-            del record.raw_stream
-            return record
+    def __process_warc_gz_stream(self, raw_stream):
+        """
+        Passes all records of a gzip compressed WARC stream to the function on_valid_article_extracted.
+        :param raw_stream: compressed stream, either a FastWARC stream or a file-like object. If isal is installed, it
+        must be a file-like object
+        :return:
+        """
+        # records are read lazily while the callback consumes them, so only one record body is held in memory at a time
+        if igzip is not None:
+            stream = igzip.IGzipFile(fileobj=raw_stream, mode='rb')
+        else:
+            stream = GZipStream(raw_stream)
+        try:
+            self.__callback_on_article_extracted(self.__iterate_warc_records(stream))
+        finally:
+            stream.close()
 
-        with open(path_name, 'rb') as stream:
-            warc_records = list(map(read_record, ArchiveIterator(stream)))
-            self.__logger.info('Extracting {} records'.format(len(warc_records)))
+    def __download_and_process_warc_gz_file(self, url, local_filepath):
+        """
+        Downloads a WARC file in a background thread and extracts its records while the download is still running, so
+        that the total time is bounded by the slower of both instead of their sum. As in __download, the file is kept
+        locally.
+        :param url:
+        :param local_filepath:
+        :return:
+        """
+        self.__logger.info('downloading and extracting %s (local: %s)', url, local_filepath)
+        download_thread = _WarcDownloadThread(url, local_filepath, self.__on_download_progress_update)
+        download_thread.start()
+        reader = _GrowingFileReader(download_thread)
+        try:
+            self.__process_warc_gz_stream(reader)
+        finally:
+            # stop downloading if the extraction failed
+            download_thread.cancelled.set()
+            download_thread.join()
+            reader.close()
+            if not download_thread.completed:
+                # do not leave a partial file behind that would be reused by the next run
+                os.remove(local_filepath)
+
+        if download_thread.error is not None:
+            raise download_thread.error
+        self.__register_local_file(url, local_filepath)
+        self.__logger.info('download completed, local file: %s', local_filepath)
+
+    def __iterate_warc_records(self, stream):
+        """
+        Iterates all response records in a WARC stream. The HTTP headers are already parsed by FastWARC, so the reader
+        of each record is positioned at the start of the HTTP payload.
+        :param stream:
+        :return: generator of (target URI, WARC date, HTTP payload) tuples, which consist of plain str and bytes only,
+        so that they are cheap to pass to other processes
+        """
+        # filter on the WARC headers first, so that discarded records are neither read nor passed to the extractors
+        valid_hosts = frozenset(host.lower() for host in self.__filter_valid_hosts or [])
+        # an article cannot have been published after it was crawled, so the WARC date is an upper bound of the
+        # publishing date. Hence, records crawled before the start date can be discarded. ISO 8601 dates can be
+        # compared as strings. WARC dates are in UTC, hence an aware start date is converted to UTC first
+        min_warc_date = None
+        if self.__filter_start_date:
+            start_date = self.__filter_start_date
+            if isinstance(start_date, datetime.datetime) and start_date.tzinfo is not None:
+                start_date = start_date.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+            min_warc_date = start_date.isoformat()
 
-        warc_records = list(map(delete_raw_stream, warc_records))
+        for record in ArchiveIterator(stream, record_types=WarcRecordType.response, parse_http=True):
+            url = record.headers.get('WARC-Target-URI')
+            if valid_hosts:
+                try:
+                    hostname = urllib.parse.urlsplit(url).hostname
+                except ValueError:
+                    # malformed URI, e.g., an invalid IPv6 address, which cannot be from one of the valid hosts
+                    continue
+                if not _is_valid_host(hostname, valid_hosts):
+                    continue
+            warc_date = record.headers.get('WARC-Date')
+            if min_warc_date and warc_date and warc_date < min_warc_date:
+                continue
 
-        self.__callback_on_article_extracted(warc_records)
+            # only HTML pages can contain articles, so skip other responses, e.g., images, PDFs, or feeds, before their
+            # payload is read and passed to the extractors. Responses without a content type are kept
+            content_type = record.http_headers.get('Content-Type') if record.http_headers is not None else None
+            if content_type and 'html' not in content_type.lower():
+                continue
+            yield url, warc_date, record.reader.read()
 
     def __run(self):
         """
@@ -211,21 +553,33 @@ class CommonCrawlExtractor:
         """
         self.__setup()
 
-        local_path_name = self.__download(self.__warc_download_url)
-        self.__process_warc_gz_file(local_path_name)
-        import sys
-        sys.exit()
+        local_path_name = self.__get_local_filepath(self.__warc_download_url)
+        if self.__extract_while_downloading and not self.__is_reusable_download(local_path_name):
+            self.__download_and_process_warc_gz_file(self.__warc_download_url, local_path_name)
+        else:
+            local_path_name = self.__download(self.__warc_download_url)
+            self.__process_warc_gz_file(local_path_name)
+
+        if os.path.isfile(local_path_name):
+            _drop_from_page_cache(local_path_name)
+
+        if self.__log_pathname_fully_extracted_warcs:
+            self.__register_fully_extracted_warc_file(self.__warc_download_url)
 
     def extract_from_commoncrawl(self, warc_download_url, callback_on_article_extracted, valid_hosts=None,
                                  start_date=None, end_date=None,
                                  strict_date=True, reuse_previously_downloaded_files=True, local_download_dir_warc=None,
                                  continue_after_error=True, show_download_progress=False,
                                  log_level=logging.ERROR, delete_warc_after_extraction=True,
-                                 log_pathname_fully_extracted_warcs=None):
+                                 log_pathname_fully_extracted_warcs=None, extract_while_downloading=True,
+                                 download_num_connections=8):
         """
         Crawl and extract articles form the news crawl provided by commoncrawl.org. For each article that was extracted
         successfully the callback function callback_on_article_extracted is invoked where the first parameter is the
         article object.
+        :param extract_while_downloading: if True, records are extracted while the WARC file is still being downloaded.
+        Otherwise, the WARC file is downloaded completely, using concurrent range requests, before the extraction starts
+        :param download_num_connections: number of concurrent range requests if extract_while_downloading is False
         :param log_pathname_fully_extracted_warcs:
         :param delete_warc_after_extraction:
         :param warc_download_url:
@@ -255,5 +609,7 @@ class CommonCrawlExtractor:
         self.__log_level = log_level
         self.__delete_warc_after_extraction = delete_warc_after_extraction
         self.__log_pathname_fully_extracted_warcs = log_pathname_fully_extracted_warcs
+        self.__extract_while_downloading = extract_while_downloading
+        self.__download_num_connections = download_num_connections
 
         self.__run()
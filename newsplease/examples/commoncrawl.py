@@ -9,9 +9,8 @@ control the number of processes with the parameter my_number_of_extraction_proce
 You can also crawl and extract articles programmatically, i.e., from within your own code, by using the class
 CommonCrawlCrawler provided in newsplease.crawler.commoncrawl_crawler.py
 
-In case the script crashes and contains a log message in the beginning that states that only 1 file on AWS storage
-was found, make sure that awscli was correctly installed. You can check that by executing aws --version from a terminal.
-If aws is not installed, you can (on Ubuntu) also install it using sudo apt-get install awscli.
+The list of WARC files on AWS storage is cached in the download dir for one hour. Delete the file .cc_index.cache in
+that dir to force fetching a fresh list.
 
 This script uses relative imports to ensure that the latest, local version of news-please is used, instead of the one
 that might have been installed with pip. Hence, you must run this script following this workflow.
@@ -20,14 +19,18 @@ cd news-please
 python3 -m newsplease.examples.commoncrawl
 """
 import argparse
+import atexit
 import gzip
-import json
 import hashlib
-import json
 import logging
 import multiprocessing
 import os
+import threading
 import time
+from functools import lru_cache
+
+import orjson
+from six.moves import queue
 
 from ..crawler import commoncrawl_crawler as commoncrawl_crawler
 
@@ -49,7 +52,7 @@ my_local_download_dir_warc = args.download_dir
 # download dir for articles
 my_local_download_dir_article = args.outfile
 my_local_download_dir_log = args.outfile + '.log'
-# hosts (if None or empty list, any host is OK)
+# hosts (if None or empty list, any host is OK), subdomains of these hosts are OK as well
 my_filter_valid_hosts = []  # example: ['elrancaguino.cl']
 # start date (if None, any date is OK as start date), as datetime
 my_filter_start_date = None  # datetime.datetime(2016, 1, 1)
@@ -73,6 +76,12 @@ my_delete_warc_after_extraction = False
 # if True, will continue extraction from the latest fully downloaded but not fully extracted WARC files and then
 # crawling new WARC files. This assumes that the filter criteria have not been changed since the previous run!
 my_continue_process = True
+# if True, articles are extracted while the WARC file is still being downloaded. Otherwise, the WARC file is downloaded
+# completely before, using my_download_num_connections concurrent range requests
+my_extract_while_downloading = True
+my_download_num_connections = 8
+# gzip compression level of the output file, 1 is fastest, 9 yields the smallest file
+my_output_compresslevel = 1
 ############ END YOUR CONFIG #########
 
 logger = logging.getLogger('chardet.charsetprober')
@@ -80,6 +89,55 @@ logger.setLevel(my_log_level)
 
 from newsplease import NewsPlease
 
+# typical number of records in a WARC file, used to derive the chunksize of the extraction pool
+__expected_records_per_warc = 40000
+# upper bound of the chunksize, so that a single task does not hold too many record bodies in memory
+__max_extraction_chunksize = 250
+# extraction processes are replaced after this many tasks to release memory accumulated by the extractors
+__max_tasks_per_extraction_process = 200
+# process pool shared by all WARC files of a run
+__extraction_pool = None
+# number of extracted articles that may wait for being written to the output file
+__max_queued_articles = 1024
+
+
+def __get_extraction_pool():
+    """
+    Returns the process pool used to extract articles from WARC records. The pool is created on first use and reused
+    for all WARC files, since starting the extraction processes takes several seconds.
+    :return:
+    """
+    global __extraction_pool
+    if __extraction_pool is None:
+        __extraction_pool = multiprocessing.Pool(maxtasksperchild=__max_tasks_per_extraction_process)
+        atexit.register(__close_extraction_pool)
+    return __extraction_pool
+
+
+def __close_extraction_pool():
+    __extraction_pool.close()
+    __extraction_pool.join()
+
+
+def __get_extraction_chunksize():
+    """
+    Number of records sent to an extraction process at once: large enough to avoid an IPC round-trip per record, while
+    still giving each process several chunks per WARC file
+    :return:
+    """
+    chunksize = __expected_records_per_warc // (4 * multiprocessing.cpu_count())
+    return max(1, min(chunksize, __max_extraction_chunksize))
+
+
+@lru_cache(maxsize=4096)
+def __ensure_dir(path):
+    """
+    Creates the directory if it does not exist yet. Results are cached, so that the file system is only accessed once
+    per directory.
+    :param path:
+    :return:
+    """
+    os.makedirs(path, exist_ok=True)
 
 
 def __get_pretty_filepath(path, article):
@@ -92,17 +150,18 @@ def __get_pretty_filepath(path, article):
     short_filename = hashlib.sha256(article.filename.encode()).hexdigest()
     sub_dir = article.source_domain
     final_path = path + sub_dir + '/'
-    if not os.path.exists(final_path):
-        os.makedirs(final_path)
+    __ensure_dir(final_path)
     return final_path + short_filename + '.json'
 
 
 def process_warc_record(record):
     try:
-        if record.rec_type == 'response':
-            article = NewsPlease.from_warc(record)
-            if article is not None:
-                return json.dumps(article.__dict__, default=str, separators=(',', ':'))
+        url, download_date, raw_html = record
+        article = NewsPlease.from_warc_payload(raw_html, url=url, download_date=download_date)
+        if article is not None:
+            # datetimes are passed through to str, so that they are written in the same format as before
+            return orjson.dumps(article.__dict__, default=str,
+                                option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
     except Exception as e:
         log = logging.getLogger()
         log.warning('skipping record due to Exception: ' + str(e))
@@ -117,43 +176,83 @@ class TimeMeter(object):
     def reset(self, init=0):
         self.init = init
         self.start = time.time()
-        self.n = 0
-
-    def update(self, val=1):
-        self.n += val
 
-    @property
-    def avg(self):
-        return self.n / self.elapsed_time
+    def avg(self, n):
+        return n / self.elapsed_time
 
     @property
     def elapsed_time(self):
         return self.init + (time.time() - self.start)
 
 
+def __write_articles(article_queue, path, errors):
+    """
+    Writes JSON encoded articles from the queue to the gzip compressed output file until None is received. This runs in
+    its own thread, so that the compression does not stall collecting the results of the extraction processes.
+    :param article_queue:
+    :param path:
+    :param errors: list to which an exception is appended if writing fails, so that it can be raised by the caller
+    :return:
+    """
+    try:
+        with gzip.open(path, 'wb', compresslevel=my_output_compresslevel) as outfile:
+            for article in iter(article_queue.get, None):
+                outfile.write(article)
+                outfile.write(b'\n')
+    except Exception as e:
+        errors.append(e)
+
+
+def __put_article(article_queue, writer, article):
+    """
+    Puts an article into the queue of the writer thread. Instead of blocking forever on a full queue, this gives up once
+    the writer has stopped.
+    :param article_queue:
+    :param writer:
+    :param article:
+    :return: True if the article has been queued, False if the writer has stopped
+    """
+    while writer.is_alive():
+        try:
+            article_queue.put(article, timeout=1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
 def on_valid_article_extracted(warc_records):
     """
     This function will be invoked for each article that was extracted successfully from the archived data and that
     satisfies the filter criteria.
-    :param articles:
+    :param warc_records: iterator of WARC records, which are read lazily from the WARC file
     :return:
     """
-    num_records = len(warc_records)
     log = logging.getLogger()
     start_time = time.time()
-    with multiprocessing.Pool() as pool:
-        json_articles = pool.imap_unordered(process_warc_record, warc_records, 25)
-
-        with gzip.open(my_local_download_dir_article, 'wt', encoding='utf-8') as outfile:
-            timer = TimeMeter()
-            for i, article in enumerate(json_articles):
-                if article is not None:
-                    print(article, file=outfile)
-                timer.update(1)
-                if i % 100 == 0:
-                    log.info('extraction timer: {}/{} at {} articles per second'.format(
-                        i+1, num_records, round(timer.avg, 1),
-                    ))
+    json_articles = __get_extraction_pool().imap_unordered(process_warc_record, warc_records,
+                                                          __get_extraction_chunksize())
+
+    article_queue = queue.Queue(maxsize=__max_queued_articles)
+    writer_errors = []
+    writer = threading.Thread(target=__write_articles,
+                              args=(article_queue, my_local_download_dir_article, writer_errors))
+    writer.start()
+    try:
+        timer = TimeMeter()
+        log_progress = log.isEnabledFor(logging.INFO)
+        for i, article in enumerate(json_articles):
+            if article is not None and not __put_article(article_queue, writer, article):
+                break
+            # log every 1024 records
+            if log_progress and not i & 0x3FF:
+                log.info('extraction timer: %i records at %s articles per second', i + 1, round(timer.avg(i + 1), 1))
+    finally:
+        __put_article(article_queue, writer, None)
+        writer.join()
+
+    if writer_errors:
+        raise writer_errors[0]
 
     end_time = time.time()
     with open(my_local_download_dir_article + '.done', 'w') as h:
@@ -175,4 +274,6 @@ if __name__ == '__main__':
                                                log_level=my_log_level,
                                                delete_warc_after_extraction=True,
                                                continue_process=True,
-                                               warc_file=args.warc_file)
+                                               warc_file=args.warc_file,
+                                               extract_while_downloading=my_extract_while_downloading,
+                                               download_num_connections=my_download_num_connections)
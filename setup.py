@@ -47,11 +47,12 @@ news-please is an open source, easy-to-use news crawler that extracts structured
           'dotmap>=1.2.17',
           'readability-lxml>=0.6.2',
           'PyDispatcher>=2.0.5',
-          'warcio>=1.3.3',
+          'FastWARC>=0.13.0,<1',
           'ago>=0.0.9',
           'six>=1.10.0',
           'lxml>=3.3.5',
-          'awscli>=1.11.117',
+          'boto3>=1.9.0',
+          'orjson>=3.0.0',
           'hurry.filesize>=0.9'
       ],
       extras_require={
@@ -65,6 +66,9 @@ news-please is an open source, easy-to-use news crawler that extracts structured
           ],
           ':sys_platform == "win32"': [
               'pywin32>=220'
+          ],
+          'isal': [
+              'isal>=1.0.0'
           ]
       },
       entry_points={
@@ -0,0 +1,180 @@
+import datetime
+import functools
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from urllib.error import ContentTooShortError, HTTPError
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+from fastwarc.stream_io import FileStream, GZipStream
+
+from newsplease.crawler.commoncrawl_extractor import CommonCrawlExtractor
+
+
+def _warc_response_record(url, html):
+    http_block = b'HTTP/1.1 200 OK\r\nContent-Type: text/html; charset=utf-8\r\n\r\n' + html
+    headers = ('WARC/1.0\r\n'
+               'WARC-Type: response\r\n'
+               'WARC-Target-URI: %s\r\n'
+               'WARC-Date: 2019-01-01T00:00:00Z\r\n'
+               'WARC-Record-ID: <urn:uuid:%08d-0000-0000-0000-000000000000>\r\n'
+               'Content-Type: application/http; msgtype=response\r\n'
+               'Content-Length: %d\r\n'
+               '\r\n') % (url, abs(hash(url)) % 10 ** 8, len(http_block))
+    # each record is a gzip member of its own, as in the files of commoncrawl.org
+    return gzip.compress(headers.encode() + http_block + b'\r\n\r\n')
+
+
+class IterateWarcRecordsTest(unittest.TestCase):
+    def setUp(self):
+        self.warc_file = tempfile.NamedTemporaryFile(suffix='.warc.gz', delete=False)
+        for url in ['https://elrancaguino.cl/a', 'http://[broken/2', 'https://www.elrancaguino.cl/b',
+                    'https://WWW.ElRancaguino.cl/c', 'https://notelrancaguino.cl/d',
+                    'https://elrancaguino.cl.example.com/e']:
+            self.warc_file.write(_warc_response_record(url, b'<html></html>'))
+        self.warc_file.close()
+
+    def tearDown(self):
+        os.remove(self.warc_file.name)
+
+    def _iterate_urls(self, extractor):
+        stream = GZipStream(FileStream(self.warc_file.name, 'rb'))
+        try:
+            return [record[0] for record in extractor._CommonCrawlExtractor__iterate_warc_records(stream)]
+        finally:
+            stream.close()
+
+    def test_valid_hosts_include_subdomains(self):
+        extractor = CommonCrawlExtractor()
+        extractor._CommonCrawlExtractor__filter_valid_hosts = ['elrancaguino.cl']
+        urls = self._iterate_urls(extractor)
+
+        self.assertEqual(urls, ['https://elrancaguino.cl/a', 'https://www.elrancaguino.cl/b',
+                                'https://WWW.ElRancaguino.cl/c'])
+
+    def test_aware_start_date_is_compared_in_utc(self):
+        extractor = CommonCrawlExtractor()
+        # 2018-12-31T23:00:00Z, i.e., before the WARC date of all records
+        extractor._CommonCrawlExtractor__filter_start_date = datetime.datetime(
+            2019, 1, 1, 1, 0, tzinfo=datetime.timezone(datetime.timedelta(hours=2)))
+        self.assertEqual(len(self._iterate_urls(extractor)), 6)
+
+        # naive start dates are treated as UTC, i.e., 2019-01-01T01:00:00Z is after the WARC date of all records
+        extractor._CommonCrawlExtractor__filter_start_date = datetime.datetime(2019, 1, 1, 1, 0)
+        self.assertEqual(self._iterate_urls(extractor), [])
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path != '/truncated.warc.gz':
+            return SimpleHTTPRequestHandler.do_GET(self)
+        # announce more bytes than are sent, as when the connection is closed prematurely
+        with open(os.path.join(self.directory, 'test.warc.gz'), 'rb') as warc_file:
+            body = warc_file.read()
+        self.send_response(200)
+        self.send_header('Content-Length', str(2 * len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.close_connection = True
+
+
+class DownloadAndProcessTest(unittest.TestCase):
+    def setUp(self):
+        self.serve_dir = tempfile.mkdtemp()
+        self.download_dir = tempfile.mkdtemp()
+        self.urls = ['http://example.com/article-%d' % i for i in range(50)]
+        with open(os.path.join(self.serve_dir, 'test.warc.gz'), 'wb') as warc_file:
+            for url in self.urls:
+                warc_file.write(_warc_response_record(url, b'<html><body>' + url.encode() * 100 + b'</body></html>'))
+
+        handler = functools.partial(_QuietHandler, directory=self.serve_dir)
+        self.server = HTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.warc_url = 'http://127.0.0.1:%d/test.warc.gz' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.serve_dir)
+        shutil.rmtree(self.download_dir)
+
+    def test_records_are_extracted_while_downloading(self):
+        records = []
+        extractor = CommonCrawlExtractor()
+        extractor._CommonCrawlExtractor__callback_on_article_extracted = records.extend
+        local_filepath = os.path.join(self.download_dir, 'test.warc.gz')
+
+        extractor._CommonCrawlExtractor__download_and_process_warc_gz_file(self.warc_url, local_filepath)
+
+        self.assertEqual([record[0] for record in records], self.urls)
+        self.assertEqual(records[0][1], '2019-01-01T00:00:00Z')
+        self.assertTrue(records[0][2].startswith(b'<html>'))
+        with open(local_filepath, 'rb') as local_file, open(os.path.join(self.serve_dir, 'test.warc.gz'), 'rb') as f:
+            self.assertEqual(local_file.read(), f.read())
+
+    def test_records_are_extracted_after_downloading(self):
+        records = []
+        CommonCrawlExtractor().extract_from_commoncrawl(self.warc_url, records.extend,
+                                                        local_download_dir_warc=self.download_dir,
+                                                        reuse_previously_downloaded_files=False,
+                                                        extract_while_downloading=False)
+
+        self.assertEqual([record[0] for record in records], self.urls)
+
+    def test_incomplete_download_is_not_reused(self):
+        # a file without .url file, e.g., left behind by a killed process, must be downloaded again
+        url_hash = hashlib.sha256(self.warc_url.encode('utf-8')).hexdigest()
+        local_filepath = os.path.join(self.download_dir, url_hash[:2], url_hash + '.warc.gz')
+        os.makedirs(os.path.dirname(local_filepath))
+        with open(local_filepath, 'wb') as local_file:
+            local_file.write(_warc_response_record(self.urls[0], b'<html></html>'))
+
+        records = []
+        CommonCrawlExtractor().extract_from_commoncrawl(self.warc_url, records.extend,
+                                                        local_download_dir_warc=self.download_dir,
+                                                        reuse_previously_downloaded_files=True,
+                                                        extract_while_downloading=False)
+
+        self.assertEqual([record[0] for record in records], self.urls)
+        self.assertTrue(os.path.isfile(local_filepath + '.url'))
+
+    def test_download_error_is_raised_while_records_are_consumed(self):
+        consumed = []
+
+        def callback(records):
+            for record in records:
+                consumed.append(record)
+            # the callback must not finish as if the WARC file was empty
+            consumed.append('finished')
+
+        extractor = CommonCrawlExtractor()
+        extractor._CommonCrawlExtractor__callback_on_article_extracted = callback
+        local_filepath = os.path.join(self.download_dir, 'missing.warc.gz')
+
+        with self.assertRaises(HTTPError):
+            extractor._CommonCrawlExtractor__download_and_process_warc_gz_file(
+                self.warc_url.replace('test.warc.gz', 'missing.warc.gz'), local_filepath)
+        self.assertNotIn('finished', consumed)
+        self.assertFalse(os.path.exists(local_filepath))
+
+    def test_truncated_download_is_not_kept(self):
+        extractor = CommonCrawlExtractor()
+        extractor._CommonCrawlExtractor__callback_on_article_extracted = list
+        local_filepath = os.path.join(self.download_dir, 'truncated.warc.gz')
+
+        with self.assertRaises(ContentTooShortError):
+            extractor._CommonCrawlExtractor__download_and_process_warc_gz_file(
+                self.warc_url.replace('test.warc.gz', 'truncated.warc.gz'), local_filepath)
+        self.assertFalse(os.path.exists(local_filepath))
+        self.assertFalse(os.path.exists(local_filepath + '.url'))
+
+
+if __name__ == '__main__':
+    unittest.main()